@@ -3,8 +3,11 @@ from discord.ext import commands
 import os
 import json
 import google.generativeai as genai
+import google.ai.generativelanguage as glm
 import asyncio
 import datetime
+import time
+import collections
 from discord import app_commands
 from flask import Flask, request, jsonify
 import sqlite3
@@ -57,46 +60,248 @@ GEMINI_API_KEYS = [
 # None（設定されていないキー）を除外
 GEMINI_API_KEYS = [key for key in GEMINI_API_KEYS if key is not None]
 
+# 使用するGeminiモデル
+GEMINI_MODEL_NAME = 'gemini-2.5-flash'
+# 不適切なコンテンツ生成を抑制
+GEMINI_SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+]
+
 # 現在使用中のAPIキーのインデックス
 current_api_key_index = 0
-# Geminiモデルのインスタンス
-model = None
+# キーのindex -> Geminiモデル (キーごとに一度だけ生成して使い回す)
+gemini_models = {}
+
+# この秒数より長く通信していないキーは、接続が切れている (コールド) とみなす
+# キープアライブはこの1/4の間隔で確認し、半分以上アイドルのキーに軽いリクエストを送る
+GEMINI_KEEPALIVE_INTERVAL = float(os.environ.get("GEMINI_KEEPALIVE_INTERVAL", "60"))
+# ウォームアップ1回あたりのタイムアウト (秒)
+GEMINI_WARMUP_TIMEOUT = float(os.environ.get("GEMINI_WARMUP_TIMEOUT", "10"))
+GEMINI_COLD_START_WINDOW = 20 # キーごとに保持するコールド時の計測値の数
+
+gemini_last_activity = {} # キーのindex -> 最後に通信 (または通信を試行) した時刻
+gemini_cold_start_times = {} # キーのindex -> コールド状態からのcount_tokens往復時間 (秒)
+gemini_cold_send_times = {} # キーのindex -> コールド状態での応答生成時間 (秒)
+gemini_ping_times = {} # キーのindex -> 直近のキープアライブのcount_tokens往復時間 (秒)
+gemini_keepalive_task = None
 
 def initialize_gemini_model():
-    """現在のAPIキーでGeminiモデルを初期化する関数"""
-    global model, current_api_key_index
-
+    """Gemini APIキーが設定されているか確認する関数 (モデルは get_gemini_model でキーごとに生成)"""
     if not GEMINI_API_KEYS:
         print("エラー: Gemini APIキーがSecretsに一つも設定されていません。")
         exit()
 
+    print(f"Gemini APIキーを {len(GEMINI_API_KEYS)} 件読み込みました (使用中のindex: {current_api_key_index})。")
+
+def get_gemini_model(key_index):
+    """指定したAPIキー専用のGeminiモデルを取得する (初回のみ生成)"""
+    # gRPCの非同期チャネルはイベントループ上で作る必要があるため、Bot起動後に呼び出すこと
+    if key_index not in gemini_models:
+        key_model = genai.GenerativeModel(GEMINI_MODEL_NAME, safety_settings=GEMINI_SAFETY_SETTINGS)
+        # genai.configure のグローバル設定は使わず、キーごとに専用の非同期クライアントを持たせる
+        key_model._async_client = glm.GenerativeServiceAsyncClient(
+            client_options={"api_key": GEMINI_API_KEYS[key_index]}
+        )
+        gemini_models[key_index] = key_model
+    return gemini_models[key_index]
+
+def is_gemini_client_idle(key_index, idle_seconds=GEMINI_KEEPALIVE_INTERVAL):
+    """キーが指定秒数以上通信しておらず、接続が切れている可能性があるか判定する"""
+    last_activity = gemini_last_activity.get(key_index)
+    return last_activity is None or time.monotonic() - last_activity >= idle_seconds
+
+def record_gemini_cold_time(samples_by_key, key_index, elapsed):
+    """コールド状態での計測値をキーごとに記録する"""
+    if key_index not in samples_by_key:
+        samples_by_key[key_index] = collections.deque(maxlen=GEMINI_COLD_START_WINDOW)
+    samples_by_key[key_index].append(elapsed)
+
+async def warm_up_gemini_client(key_index):
+    """トークン数カウントの軽いリクエストで接続を確立・維持し、その往復時間を返す (失敗時はNone)"""
+    is_cold = is_gemini_client_idle(key_index)
+    start = time.monotonic()
+    try:
+        await asyncio.wait_for(get_gemini_model(key_index).count_tokens_async("ping"), timeout=GEMINI_WARMUP_TIMEOUT)
+        elapsed = time.monotonic() - start
+    except asyncio.TimeoutError:
+        print(f"APIキー (index: {key_index}) の接続ウォームアップが {GEMINI_WARMUP_TIMEOUT} 秒でタイムアウトしました。")
+        return None
+    except Exception as e:
+        print(f"APIキー (index: {key_index}) の接続ウォームアップに失敗しました: {e}")
+        return None
+    finally:
+        # 失敗したキーも試行時刻を記録し、次の確認まで再試行しない
+        gemini_last_activity[key_index] = time.monotonic()
+
+    # 起動直後やアイドル後の往復時間は、接続維持中のものと分けて記録する
+    if is_cold:
+        record_gemini_cold_time(gemini_cold_start_times, key_index, elapsed)
+    else:
+        gemini_ping_times[key_index] = elapsed
+    return elapsed
+
+async def warm_up_gemini_clients():
+    """すべてのAPIキーのクライアントを生成し、並行して接続を確立しておく"""
+    results = await asyncio.gather(*(warm_up_gemini_client(i) for i in range(len(GEMINI_API_KEYS))))
+    for key_index, elapsed in enumerate(results):
+        if elapsed is not None:
+            print(f"APIキー (index: {key_index}) の接続を確立しました (count_tokens往復 {elapsed:.2f}秒)。")
+
+# 起動時に全キーの接続を確立し、その後はアイドル中のキーに軽いリクエストを送って接続を維持するタスク
+async def periodic_gemini_keepalive():
+    try:
+        await warm_up_gemini_clients()
+    except Exception as e:
+        print(f"Gemini接続のウォームアップ中にエラー: {e}")
+
+    check_interval = GEMINI_KEEPALIVE_INTERVAL / 4
+    next_check = time.monotonic()
     while True:
+        # 確認にかかった時間で間隔が延びないよう、前回の予定時刻を基準に次の確認を決める
+        next_check = max(next_check + check_interval, time.monotonic())
+        await asyncio.sleep(next_check - time.monotonic())
         try:
-            current_key = GEMINI_API_KEYS[current_api_key_index]
-            genai.configure(api_key=current_key)
-            model = genai.GenerativeModel(
-                'gemini-2.5-flash', # 使用するGeminiモデル
-                safety_settings=[ # 不適切なコンテンツ生成を抑制
-                    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-                    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-                    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-                    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-                ]
-            )
-            print(f"GeminiモデルをAPIキー (index: {current_api_key_index}) で初期化しました。")
-            break # 正常に初期化できたらループを抜ける
+            # 応答しないキーが他のキーの接続維持を遅らせないよう、並行して送る
+            idle_keys = [i for i in range(len(GEMINI_API_KEYS)) if is_gemini_client_idle(i, GEMINI_KEEPALIVE_INTERVAL / 2)]
+            await asyncio.gather(*(warm_up_gemini_client(i) for i in idle_keys))
         except Exception as e:
-            print(f"APIキー (index: {current_api_key_index}) でのGeminiモデル初期化に失敗しました: {e}")
-            current_api_key_index += 1
-            if current_api_key_index >= len(GEMINI_API_KEYS):
-                print("エラー: 利用可能なすべてのGemini APIキーでモデルの初期化に失敗しました。")
-                exit()
-            print(f"次のAPIキー (index: {current_api_key_index}) を試します。")
-
-# Bot起動時に一度モデルを初期化
+            print(f"Geminiキープアライブ中にエラー: {e}")
+
+# Bot起動時に一度APIキーを確認
 initialize_gemini_model()
 # ★ここまでGemini APIキー管理の変更点★
 
+# ---------------- ↓ Geminiリクエストのヘッジ (応答遅延対策) ↓ ----------------
+
+# GEMINI_HEDGE_ENABLED=1 のときだけ、遅い応答に対して別キーで複製リクエストを送る
+GEMINI_HEDGE_ENABLED = os.environ.get("GEMINI_HEDGE_ENABLED", "0") == "1"
+# 1分あたりに送ってよい複製リクエストの上限 (クォータ消費を抑えるため)
+GEMINI_HEDGE_BUDGET_PER_MINUTE = int(os.environ.get("GEMINI_HEDGE_BUDGET_PER_MINUTE", "5"))
+# 応答時間のサンプルが少ない間に使う待ち時間 (秒)
+GEMINI_HEDGE_DEFAULT_DELAY = float(os.environ.get("GEMINI_HEDGE_DEFAULT_DELAY", "8.0"))
+HEDGE_MIN_SAMPLES = 10 # p95を使い始めるのに必要なサンプル数
+HEDGE_LATENCY_WINDOW = 50 # キーごとに保持する直近の応答時間の数
+
+gemini_latency_samples = {} # キーのindex -> 直近の応答時間 (秒)
+hedge_sent_times = collections.deque() # 直近1分間に複製リクエストを送った時刻
+hedge_stats = {"requests": 0, "fired": 0, "won": 0, "skipped_budget": 0, "skipped_no_key": 0}
+hedge_quota_exhausted_keys = set() # 複製リクエストでクォータ制限 (429) が返ったキーのindex
+
+def is_quota_error(e):
+    """Gemini APIのクォータ制限エラーか判定する"""
+    return "429 You exceeded your current quota" in str(e)
+
+def record_gemini_latency(key_index, elapsed):
+    """キーごとの応答時間を記録する"""
+    if key_index not in gemini_latency_samples:
+        gemini_latency_samples[key_index] = collections.deque(maxlen=HEDGE_LATENCY_WINDOW)
+    gemini_latency_samples[key_index].append(elapsed)
+
+def get_hedge_delay(key_index):
+    """複製リクエストを送るまでの待ち時間 (直近の応答時間のp95) を返す"""
+    samples = gemini_latency_samples.get(key_index)
+    if not samples or len(samples) < HEDGE_MIN_SAMPLES:
+        return GEMINI_HEDGE_DEFAULT_DELAY
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+def get_hedge_index(primary_index):
+    """複製リクエストの送り先キーを返す (使えるキーがなければNone)"""
+    # キーはクォータ切れでしか切り替えないので、現在より前のキーは使い切っている
+    for key_index in range(primary_index + 1, len(GEMINI_API_KEYS)):
+        if key_index not in hedge_quota_exhausted_keys:
+            return key_index
+    return None
+
+def consume_hedge_budget():
+    """1分あたりの予算が残っていれば消費してTrueを返す"""
+    now = time.monotonic()
+    while hedge_sent_times and now - hedge_sent_times[0] >= 60:
+        hedge_sent_times.popleft()
+    if len(hedge_sent_times) >= GEMINI_HEDGE_BUDGET_PER_MINUTE:
+        return False
+    hedge_sent_times.append(now)
+    return True
+
+def record_gemini_send_time(key_index, is_cold, elapsed):
+    """送信1回分の応答時間を、コールドかどうかで分けて記録する"""
+    if is_cold:
+        record_gemini_cold_time(gemini_cold_send_times, key_index, elapsed)
+    else:
+        record_gemini_latency(key_index, elapsed)
+
+async def timed_send_message(key_index, history, prompt_content):
+    """チャットを開始してメッセージを送信し、応答時間を記録する"""
+    # 返信前に余計な通信はせず、接続が切れていそうな状態での送信はコールドとして別に記録する
+    is_cold = is_gemini_client_idle(key_index)
+    start = time.monotonic()
+    try:
+        chat_session = get_gemini_model(key_index).start_chat(history=history)
+        response = await chat_session.send_message_async(prompt_content)
+    finally:
+        gemini_last_activity[key_index] = time.monotonic()
+    record_gemini_send_time(key_index, is_cold, time.monotonic() - start)
+    return response
+
+async def send_message_with_hedging(history, prompt_content):
+    """Geminiに送信し、応答が遅ければ別キーに複製を送って先に返った方を採用する"""
+    primary_index = current_api_key_index
+    primary_is_cold = is_gemini_client_idle(primary_index)
+    primary_start = time.monotonic()
+    primary_task = asyncio.create_task(timed_send_message(primary_index, history, prompt_content))
+    pending = {primary_task}
+    try:
+        if not GEMINI_HEDGE_ENABLED or len(GEMINI_API_KEYS) < 2:
+            return await primary_task
+
+        hedge_stats["requests"] += 1
+        # 送信前に接続確立などの待ちは挟まないので、ここからの待ち時間はp95のサンプルと同じ基準になる
+        done, pending = await asyncio.wait(pending, timeout=get_hedge_delay(primary_index))
+        if done:
+            return primary_task.result()
+
+        hedge_index = get_hedge_index(primary_index)
+        if hedge_index is None:
+            hedge_stats["skipped_no_key"] += 1
+            return await primary_task
+
+        if not consume_hedge_budget():
+            hedge_stats["skipped_budget"] += 1
+            return await primary_task
+
+        hedge_stats["fired"] += 1
+        print(f"Geminiの応答が遅いため、APIキー (index: {hedge_index}) に複製リクエストを送ります。")
+        hedge_task = asyncio.create_task(
+            timed_send_message(hedge_index, history, prompt_content)
+        )
+        pending.add(hedge_task)
+
+        # 先に成功した方を採用し、両方失敗した場合は元のリクエストのエラーを返す
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            # 同時に終わった場合も、すべてのタスクの例外を取り出してから判定する
+            errors = {task: task.exception() for task in done}
+            if is_quota_error(errors.get(hedge_task)):
+                hedge_quota_exhausted_keys.add(hedge_index)
+                print(f"複製リクエスト先のAPIキー (index: {hedge_index}) はクォータ制限に達しています。")
+            if errors.get(primary_task, True) is None:
+                return primary_task.result()
+            if errors.get(hedge_task, True) is None:
+                hedge_stats["won"] += 1
+                print(f"複製リクエスト (index: {hedge_index}) の応答を採用しました。")
+                if primary_task in pending:
+                    # 負けた元のリクエストは、キャンセルまでの時間を下限値として記録する
+                    record_gemini_send_time(primary_index, primary_is_cold, time.monotonic() - primary_start)
+                return hedge_task.result()
+        raise primary_task.exception()
+    finally:
+        # 負けた方のリクエストはキャンセルする
+        for task in pending:
+            task.cancel()
+
 # ---------------- ↓ データ・プロファイル関連の関数 ↓ ----------------
 
 def get_gdrive_service():
@@ -356,7 +561,8 @@ async def learn_from_conversation(message: discord.Message):
 抽出した事実:
 """
     try:
-        response = await model.generate_content_async(extraction_prompt)
+        response = await get_gemini_model(current_api_key_index).generate_content_async(extraction_prompt)
+        gemini_last_activity[current_api_key_index] = time.monotonic()
         new_fact = response.text.strip()
 
         if new_fact.lower() != "none" and len(new_fact) > 5:
@@ -398,6 +604,12 @@ async def on_ready():
     
     load_data() # data.jsonは今まで通り（起動時に読み込み、終了時に消える）
 
+    # 最初の返信で接続確立を待たないよう、全キーの接続を裏で確立しておく
+    # 再接続で on_ready が複数回呼ばれても、ウォームアップとキープアライブは一度だけ開始する
+    global gemini_keepalive_task
+    if gemini_keepalive_task is None:
+        gemini_keepalive_task = client.loop.create_task(periodic_gemini_keepalive())
+
     try:
         await tree.sync()
         print("グローバルスラッシュコマンド同期完了！")
@@ -505,6 +717,31 @@ async def taku_showlog(interaction: discord.Interaction):
     else:
         await interaction.response.send_message(f"**拓海さんの発言履歴:**\n```\n{log_content}\n```", ephemeral=True)
 
+@tree.command(name="taku_hedge_stats", description="Geminiリクエストのヘッジ状況とコールドスタート時間を表示します。")
+async def taku_hedge_stats(interaction: discord.Interaction):
+    """複製リクエストの発動回数・採用回数と、キーごとの待ち時間・コールドスタート時間を表示します。"""
+    lines = [
+        f"ヘッジ: {'有効' if GEMINI_HEDGE_ENABLED else '無効'} (上限 {GEMINI_HEDGE_BUDGET_PER_MINUTE} 回/分)",
+        f"対象リクエスト: {hedge_stats['requests']}",
+        f"複製を送信: {hedge_stats['fired']}",
+        f"複製が勝利: {hedge_stats['won']}",
+        f"予算切れで見送り: {hedge_stats['skipped_budget']}",
+        f"送り先のキーがなく見送り: {hedge_stats['skipped_no_key']}",
+    ]
+    for key_index in range(len(GEMINI_API_KEYS)):
+        sample_count = len(gemini_latency_samples.get(key_index, []))
+        lines.append(f"キー {key_index}: 待ち時間 {get_hedge_delay(key_index):.2f}秒 (サンプル {sample_count} 件)")
+        # count_tokensの往復時間はサーバー側の処理時間も含む
+        cold_starts = gemini_cold_start_times.get(key_index)
+        cold_sends = gemini_cold_send_times.get(key_index)
+        ping_time = gemini_ping_times.get(key_index)
+        lines.append(
+            f"  コールド時count_tokens往復 (処理込み): {f'{cold_starts[-1]:.2f}秒 ({len(cold_starts)} 件)' if cold_starts else 'なし'}"
+            f" / コールド時応答生成: {f'{cold_sends[-1]:.2f}秒 ({len(cold_sends)} 件)' if cold_sends else 'なし'}"
+            f" / キープアライブ往復: {f'{ping_time:.2f}秒' if ping_time is not None else 'なし'}"
+        )
+    await interaction.response.send_message("**Geminiヘッジ統計:**\n```\n" + "\n".join(lines) + "\n```", ephemeral=True)
+
 # ---------------- ↓ 通常のメッセージに対する応答 ↓ ----------------
 @client.event
 async def on_message(message):
@@ -572,11 +809,8 @@ async def on_message(message):
             try:
                 # Geminiモデルでチャットを開始し、履歴を渡す
                 # ただし、今回は全ての指示をprompt_contentに含めるため、start_chatのhistoryは直前の会話履歴のみ
-                chat_session = model.start_chat(history=gemini_history_for_prompt)
-
-                # generate_content_async を使用し、直接プロンプトを送信
-                # send_message を send_message_async に変更
-                response = await chat_session.send_message_async(prompt_content)
+                # 応答が遅い場合は別キーへの複製リクエストで待ち時間を抑える
+                response = await send_message_with_hedging(gemini_history_for_prompt, prompt_content)
                 ai_response_text = response.text.strip() # stripping to clean up whitespace
 
                 # AIが生成したテキストの先頭に特定のプレフィックスがある場合、それを除去するセーフティネット
@@ -614,7 +848,7 @@ async def on_message(message):
             except Exception as e:
                 print(f"エラー: AIの応答生成に失敗しました - {e}")
                 # クォータエラーの場合、APIキーを切り替える処理
-                if "429 You exceeded your current quota" in str(e):
+                if is_quota_error(e):
                     await message.channel.send("すまん、今日しゃべりすぎたからAPIキー切り替えるわ")
                     print("クォータ制限に達しました。次のAPIキーに切り替えます。")
                     switch_gemini_api_key() # APIキー切り替え関数を呼び出す
@@ -626,34 +860,17 @@ async def on_message(message):
 # ★ここから新しいヘルパー関数を追加★
 def switch_gemini_api_key():
     """Gemini APIキーを次の利用可能なものに切り替える関数"""
-    global current_api_key_index, model
+    global current_api_key_index
 
     # 現在のキーの次のインデックスに移動
     current_api_key_index = (current_api_key_index + 1) % len(GEMINI_API_KEYS)
     print(f"APIキーをインデックス {current_api_key_index} に切り替えます。")
 
-    try:
-        current_key = GEMINI_API_KEYS[current_api_key_index]
-        genai.configure(api_key=current_key)
-        # 新しいAPIキーでモデルを再初期化
-        model = genai.GenerativeModel(
-            'gemini-2.5-flash',
-            safety_settings=[
-                {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-            ]
-        )
-        print("Geminiモデルが新しいAPIキーで再初期化されました。")
-    except Exception as e:
-        print(f"エラー: APIキー切り替え後のモデル初期化に失敗しました: {e}")
-        # 全てのキーを使い果たした場合の最終的なエラーハンドリング
-        if current_api_key_index == 0: # 一周して最初のキーに戻ってしまった場合
-            print("警告: すべてのAPIキーがクォータ制限に達したか、無効です。")
-            # Botを終了させるか、特定のエラーメッセージを継続的に表示するか
-            # ここではBotを終了させる代わりに、エラーメッセージを出し続けるようにします。
-        # エラーが出た場合でも、次のリクエストで再度切り替えを試みるため、ここでexitはしない
+    # モデルはキーごとに専用のクライアントを持っているので、作り直しや再設定は不要
+    if current_api_key_index == 0: # 一周して最初のキーに戻ってしまった場合
+        print("警告: すべてのAPIキーがクォータ制限に達した可能性があります。")
+        # 最初のキーからやり直すので、どのキーも複製リクエストの送り先に戻す
+        hedge_quota_exhausted_keys.clear()
 
 # ---------------- ↓ Botの起動部分 ↓ ----------------
 def history_prompt_for_display(history): # 新しいヘルパー関数